@@ -1,4 +1,5 @@
-from typing import Set
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, TextIO
+import datetime
 import os
 import re
 import io
@@ -9,7 +10,25 @@ logging.basicConfig(format='%(asctime)s %(name)s %(message)s', level=logging.DEB
 
 logger = logging.getLogger(__name__)
 
-def parse_clippings(source_file: str, output_directory: str, encoding: str = "utf-8", include_clip_meta: bool = False) -> Set[str]:
+_COLON_RE = re.compile(" *: *")
+_PAREN_RE = re.compile(r"\((.+?)\)")
+_BAD_CHARS_RE = re.compile(r"[^a-zA-Z\d\s\w;,_-]+")
+_TRIM_RE = re.compile(r"^\W+|\W+$")
+
+_MONTHS = {
+    "January": 1, "February": 2, "March": 3, "April": 4, "May": 5, "June": 6,
+    "July": 7, "August": 8, "September": 9, "October": 10, "November": 11, "December": 12,
+}
+
+
+class Highlight(NamedTuple):
+    """A parsed clipping: its text, its metadata line and the date it was clipped on, None if it can't be read."""
+    text: str
+    meta: str
+    date: Optional[datetime.datetime]
+
+
+def parse_clippings(source_file: str, output_directory: str, encoding: str = "utf-8", include_clip_meta: bool = False) -> Dict[str, List[Highlight]]:
     """
     Parse Kindle clippings and organize them by book on separate .txt files.
 
@@ -26,8 +45,8 @@ def parse_clippings(source_file: str, output_directory: str, encoding: str = "ut
 
     Returns
     -------
-    Set[str]
-        A set of output file paths created.
+    Dict[str, List[Highlight]]
+        The output file paths created, mapped to the highlights written in each file.
     """
     logger.info(f'Processing highlights file: {source_file}')
     if not os.path.isfile(source_file):
@@ -36,55 +55,120 @@ def parse_clippings(source_file: str, output_directory: str, encoding: str = "ut
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
 
-    output_files = set()
+    output_files: Dict[str, List[Highlight]] = {}
+    existing_files = set(os.listdir(output_directory))
+    seen_clips: Dict[str, Set[str]] = {}
+    # Text to write in each file, written at once with the mode it has to be opened with
+    pending_writes: Dict[str, List[str]] = {}
+    write_modes: Dict[str, str] = {}
     title = ""
 
-    with io.open(source_file, "r", encoding=encoding, errors="ignore") as f:
-
-        highlight_chunks = f.read().split("==========")
-        logger.info(f'{len(highlight_chunks)} highligths identified')
-        for highlight in tqdm(highlight_chunks):
-            lines = highlight.split("\n")[1:]
-            if len(lines) < 3 or lines[3] == "":
-                continue
-
-            title = lines[0]
-            if title[0] == "\ufeff":
-                title = title[1:]
-
-            outfile_name = remove_chars(title, output_directory) + ".txt"
-            path = os.path.join(output_directory, outfile_name)
-
-            if outfile_name not in (list(output_files) + os.listdir(output_directory)):
-                logger.info(f'New highligths recognized from the book: {title}')
-                mode = "w"
-                output_files.add(path)
-                current_text = ""
-            else:
-                mode = "a"
-                with io.open(path, "r", encoding=encoding, errors="ignore") as textfile:
-                    current_text = textfile.read()
-
-            clipping_text = lines[3]
-            clip_meta = lines[1]
-
-            with io.open(path, mode, encoding=encoding, errors="ignore") as outfile:
-                if clipping_text not in current_text:
-                    outfile.write(clipping_text + "\n")
+    try:
+        with io.open(source_file, "r", encoding=encoding, errors="ignore") as f:
+
+            # The byte order mark can only be at the start of the file
+            if f.read(1) != "\ufeff":
+                f.seek(0)
+
+            for highlight in tqdm(iter_highlight_chunks(f), unit=" highlights"):
+                # Only the title, meta and text lines are needed, the rest of the chunk is not split
+                lines = highlight.lstrip("\n").split("\n", 4)
+                if len(lines) < 4 or lines[3] == "":
+                    continue
+
+                title = lines[0]
+
+                outfile_name = remove_chars(title, output_directory) + ".txt"
+                path = os.path.join(output_directory, outfile_name)
+
+                if outfile_name not in seen_clips:
+                    if outfile_name not in existing_files:
+                        logger.info(f'New highligths recognized from the book: {title}')
+                        write_modes[path] = "w"
+                        output_files[path] = []
+                        seen_clips[outfile_name] = set()
+                    else:
+                        write_modes[path] = "a"
+                        with io.open(path, "r", encoding=encoding, errors="ignore") as textfile:
+                            written_chunks = textfile.read().split("\n...\n\n")
+                        seen_clips[outfile_name] = {chunk.split("\n", 1)[0] for chunk in written_chunks if chunk}
+                    pending_writes[path] = []
+
+                clipping_text = lines[3]
+                clip_meta = lines[1]
+
+                if clipping_text not in seen_clips[outfile_name]:
+                    seen_clips[outfile_name].add(clipping_text)
+                    pending_writes[path].append(clipping_text + "\n")
                     if include_clip_meta:
-                        outfile.write(clip_meta + "\n")
-                    outfile.write("\n...\n\n")
+                        pending_writes[path].append(clip_meta + "\n")
+                    pending_writes[path].append("\n...\n\n")
+
+                    if path in output_files:
+                        try:
+                            clip_date = extract_date_and_time(clip_meta)
+                        except (IndexError, KeyError, ValueError):
+                            # Kindles in other languages or regions write the date differently
+                            clip_date = None
+                        output_files[path].append(Highlight(clipping_text, clip_meta if include_clip_meta else "", clip_date))
+    finally:
+        # What was parsed is written even if the parse stops on an unexpected error
+        for path, chunks in pending_writes.items():
+            with io.open(path, write_modes[path], encoding=encoding, errors="ignore") as outfile:
+                outfile.write("".join(chunks))
 
     return output_files
 
 
+def iter_highlight_chunks(f: TextIO, separator: str = "==========", block_size: int = 1 << 16) -> Iterator[str]:
+    """
+    Lazily splits a clippings file on the separator, reading it in blocks.
+
+    Parameters
+    ----------
+    f : TextIO
+        Opened clippings file.
+    separator : str, optional
+        String separating two clippings, by default '=========='.
+    block_size : int, optional
+        Number of characters read at once, by default 65536.
+
+    Yields
+    ------
+    str
+        Text of each clipping between two separators.
+    """
+    buffer = ""
+    for block in iter(lambda: f.read(block_size), ""):
+        buffer += block
+        start = 0
+        while (end := buffer.find(separator, start)) != -1:
+            yield buffer[start:end]
+            start = end + len(separator)
+        buffer = buffer[start:]
+    if buffer:
+        yield buffer
+
+
+def extract_date_and_time(string: str) -> datetime.datetime:
+    """Extracts the date and time from the string and returns a datetime object."""
+    date_and_time_str = string.split("Added on ")[1]
+    _, date_time_str = date_and_time_str.split(", ")
+    # Parsed by hand, strptime is much slower when called for every clipping
+    day, month, year, time_str = date_time_str.split()
+    hour, minute, second = time_str.split(":")
+    date_time = datetime.datetime(int(year), _MONTHS[month], int(day), int(hour), int(minute), int(second))
+
+    return date_time
+
+
 def remove_chars(s: str, output_directory: str = "") -> str:
     """Removes special characters from a string to make it a valid filename."""
-    s = re.sub(" *: *", " - ", s)
+    s = _COLON_RE.sub(" - ", s)
     s = s.replace("?", "").replace("&", "and")
-    s = re.sub(r"\((.+?)\)", r"- \1", s)
-    s = re.sub(r"[^a-zA-Z\d\s\w;,_-]+", "", s)
-    s = re.sub(r"^\W+|\W+$", "", s)
+    s = _PAREN_RE.sub(r"- \1", s)
+    s = _BAD_CHARS_RE.sub("", s)
+    s = _TRIM_RE.sub("", s)
 
     max_length = 245 - len(output_directory)
     return s[:max_length]
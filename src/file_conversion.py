@@ -1,20 +1,24 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import logging
 import docx
-from .pdf_helpers import prepare_pdf_document
+from .clippings_parser import Highlight
 
 logging.basicConfig(format='%(asctime)s %(name)s %(message)s', level=logging.DEBUG)
 
 logger = logging.getLogger(__name__)
 
-def convert_to_format(file_path: str, output_format: str) -> str:
+def convert_to_format(file_path: str, highlights: list[Highlight], output_format: str) -> str:
     """
-    Converts a text file into the specified format (pdf or docx).
+    Converts the highlights of a parsed text file into the specified format (pdf or docx).
 
     Parameters
     ----------
     file_path : str
-        Path of the text file to convert.
+        Path of the parsed text file, used to name the output file.
+    highlights : list[Highlight]
+        Highlights of the book, as parsed from the clippings file.
     output_format : str
         Output format, either 'pdf' or 'docx'.
     
@@ -25,33 +29,36 @@ def convert_to_format(file_path: str, output_format: str) -> str:
     """
     formatted_file_path = f"{Path(file_path).parent}/{Path(file_path).stem}.{output_format}"
     file_name = Path(file_path).stem
+    logger.info(f'Converting book {Path(file_path).name}')
 
-    with open(file_path, "r+", encoding="utf8") as txt_file:
-        paragraph = txt_file.read().split("\n")
+    if output_format == "pdf":
+        # Imported here so that docx conversions don't load the pdf dependencies
+        from .pdf_helpers import prepare_pdf_document
 
-        if output_format == "pdf":
-            pdf_file = prepare_pdf_document(paragraph, file_name)
-            pdf_file.output(formatted_file_path)
+        pdf_file = prepare_pdf_document(highlights, file_name)
+        pdf_file.output(formatted_file_path)
 
-        elif output_format == "docx":
-            docx_file = docx.Document()
-            docx_file.add_heading(file_name, 0)
+    elif output_format == "docx":
+        docx_file = docx.Document()
+        docx_file.add_heading(file_name, 0)
 
-            for para in paragraph:
-                docx_file.add_paragraph(para)
-            docx_file.save(formatted_file_path)
+        for highlight in highlights:
+            docx_file.add_paragraph(highlight.text)
+            if highlight.meta:
+                docx_file.add_paragraph(highlight.meta)
+        docx_file.save(formatted_file_path)
 
     return formatted_file_path
 
 
-def convert_files_to_formatted_highlights(files: list[str], output_format: str) -> list[str]:
+def convert_files_to_formatted_highlights(files: dict[str, list[Highlight]], output_format: str) -> list[str]:
     """
-    Iterates over list of text filesand converts them to the specified format.
+    Converts the parsed books to the specified format, spreading them across worker processes.
 
     Parameters
     ----------
-    files : list[str]
-        Path list of text files to convert.
+    files : dict[str, list[Highlight]]
+        Paths of the parsed text files mapped to their highlights, as returned by parse_clippings.
     output_format : str
         Output format, either 'pdf' or 'docx'.
     
@@ -60,11 +67,15 @@ def convert_files_to_formatted_highlights(files: list[str], output_format: str)
     List[str]
         List of paths to created files.
     """
-    output_files = []
     logger.info(f'Converting highlights to {output_format} for {len(files)} books')
-    for file in files:
-        logger.info(f'Converting book {Path(file).name}')
-        converted_file = convert_to_format(file, output_format)
-        output_files.append(converted_file)
+    if output_format == "pdf":
+        from .pdf_helpers import cache_pdf_font
+
+        # Written once here, the workers would otherwise race to create and read the font cache
+        cache_pdf_font()
+
+    # Books are independent from each other, so they are converted in parallel
+    with ProcessPoolExecutor() as executor:
+        output_files = list(executor.map(partial(convert_to_format, output_format=output_format), files.keys(), files.values()))
 
     return output_files
@@ -1,22 +1,27 @@
 import logging
-import re
-import datetime
 from fpdf import FPDF
-import pandas as pd
+import numpy as np
 import Levenshtein
+from .clippings_parser import Highlight
 
 logging.basicConfig(format='%(asctime)s %(name)s %(message)s', level=logging.DEBUG)
 
 logger = logging.getLogger(__name__)
 
-def prepare_pdf_document(highlights: list[str], title: str = "Your Notes And Highlights") -> FPDF:
+SIMILARITY_THRESHOLD = 0.3
+# Pairs of highlights sharing fewer trigrams than this are not compared with Levenshtein
+TRIGRAM_THRESHOLD = 0.2
+
+FONT_PATH = "media/Lisboa.ttf"
+
+def prepare_pdf_document(highlights: list[Highlight], title: str = "Your Notes And Highlights") -> FPDF:
     """
     Creates a PDF document from the highlights list.
 
     Parameters
     ----------
-    highlights : list[str]
-        List of text highlights.
+    highlights : list[Highlight]
+        List of parsed highlights of the book.
     title : str, optional
         Title of the PDF document, by default "Your Notes And Highlights".
 
@@ -25,28 +30,36 @@ def prepare_pdf_document(highlights: list[str], title: str = "Your Notes And Hig
     FPDF
         FPDF object with the document content.
     """
-    df_highlights = create_df_from_highlights_list(highlights)
+    highlights = filter_repeated_highlights(highlights)
 
     pdf_file = FPDF()
     pdf_file.add_page()
-    pdf_file.add_font("lisboa", "", "media/Lisboa.ttf", uni=True)
+    pdf_file.add_font("lisboa", "", FONT_PATH, uni=True)
     pdf_file.set_font("lisboa", "", 22)
     pdf_file.set_margins(25, 40, 25)
+    # fpdf writes the draw color to the page on every call and keeps it across pages, so it is set only once
+    pdf_file.set_draw_color(191, 191, 191)
     pdf_file = insert_line_break_in_pdf(pdf_file, 3)
     pdf_file.multi_cell(0, 8, title, align="C")
     pdf_file = insert_line_break_in_pdf(pdf_file, 2)
 
+    # Methods bound once, they are called several times for every highlight
+    set_font = pdf_file.set_font
+    set_text_color = pdf_file.set_text_color
+    multi_cell = pdf_file.multi_cell
+
     page_number = 1
-    for _, highlight_content in df_highlights.iterrows():
+    for highlight in highlights:
         preivous_height = pdf_file.y
         # create muti-cell pdf object and add text to it
-        pdf_file.set_font("lisboa", "", 15)
-        pdf_file.set_text_color(0, 0, 0)
-        pdf_file.multi_cell(0, 7, highlight_content["highlight"], 0)
-
-        pdf_file.set_font("lisboa", "", 11)
-        pdf_file.set_text_color(77, 77, 77)
-        pdf_file.multi_cell(0, 5, highlight_content["meta"], 0)
+        set_font("lisboa", "", 15)
+        set_text_color(0, 0, 0)
+        multi_cell(0, 7, highlight.text, 0)
+
+        if highlight.meta:
+            set_font("lisboa", "", 11)
+            set_text_color(77, 77, 77)
+            multi_cell(0, 5, highlight.meta, 0)
         pdf_file = insert_bar_separator_in_pdf(pdf_file)
 
         new_height = pdf_file.y
@@ -57,93 +70,104 @@ def prepare_pdf_document(highlights: list[str], title: str = "Your Notes And Hig
 
     return pdf_file
 
+def cache_pdf_font() -> None:
+    """
+    Loads the font once so that fpdf writes its metrics cache (a .pkl next to the font file).
+    fpdf doesn't lock that file, so it must exist before several processes render pdfs at the same time.
+    """
+    FPDF().add_font("lisboa", "", FONT_PATH, uni=True)
+
+
 def insert_line_break_in_pdf(pdf_file: FPDF, num_breaks: int = 1) -> FPDF:
     """
     Inserts a line break in a pdf for num_breaks times
     """
-    while num_breaks != 0:
-        pdf_file.multi_cell(0, 5, "", 0)
-        num_breaks -= 1
+    for _ in range(num_breaks):
+        # Unlike the text cells, ln doesn't add a page when the bottom margin is reached
+        if pdf_file.y + 5 > pdf_file.page_break_trigger and pdf_file.accept_page_break():
+            pdf_file.add_page()
+        pdf_file.ln(5)
 
     return pdf_file
 
 
 def insert_bar_separator_in_pdf(pdf_file: FPDF) -> FPDF:
     """
-    Inserts a bar separator in a pdf, useful to separate highlights
+    Inserts a bar separator in a pdf with the current draw color, useful to separate highlights
     """
     pdf_file = insert_line_break_in_pdf(pdf_file)
-    pdf_file.set_draw_color(191, 191, 191)
     pdf_file.line(40, pdf_file.y, 150, pdf_file.y)
     pdf_file = insert_line_break_in_pdf(pdf_file)
 
     return pdf_file
 
 
-def extract_date_and_time(string: str):
-    """Extracts the date and time from the string and returns a datetime object."""
-    date_and_time_str = string.split("Added on ")[1]
-    _, date_time_str = date_and_time_str.split(", ")
-    date_time = datetime.datetime.strptime(date_time_str, "%d %B %Y %H:%M:%S")
-
-    return date_time
-
-
-def calculate_similarity(string1: str, string2: str)->float:
+def calculate_similarity(string1: str, string2: str, score_cutoff: float = 0.0)->float:
+    """Computes the normalized Levenshtein similarity between two strings.
+    Similarities below score_cutoff are not computed exactly and are reported as 0."""
     if string1 is None or string2 is None:
         return 0
-    distance = Levenshtein.distance(string1, string2)
-    similarity = 1 - (distance / max(len(string1), len(string2)))
+    longest = max(len(string1), len(string2))
+    # The distance is at least the length difference, so the similarity can't exceed this ratio
+    if min(len(string1), len(string2)) / longest < score_cutoff:
+        return 0.0
+    max_distance = int(longest * (1 - score_cutoff))
+    distance = Levenshtein.distance(string1, string2, score_cutoff=max_distance)
+    if distance > max_distance:
+        return 0.0
+    similarity = 1 - (distance / longest)
     return similarity
 
 
-def filter_repeated_highlights(df_highlights: pd.DataFrame)-> pd.DataFrame:
-    """Takes a dataframe with highlights and removes the repetaed highlights. The most recent highlight is kept.
+def get_trigrams(string: str) -> frozenset[str]:
+    """Returns the set of three character substrings of a string."""
+    return frozenset(string[i:i + 3] for i in range(len(string) - 2))
 
-    Parameters
-    ----------
-    df_highlights : pd.DataFrame
-        Dataframe with the list of highlights and the columns ["highlight", "meta", "date"]
-    """
-    df_highlights["next_highlight"] = df_highlights["highlight"].shift(-1)
-    df_highlights["correlaton"] = df_highlights.apply(lambda x: calculate_similarity(x["highlight"], x["next_highlight"]), axis=1)
-    df_highlights["time_diff"] = df_highlights["date"].shift(-1) - df_highlights["date"]
-    df_highlights["correlaton_greater"] = df_highlights["correlaton"] > 0.3
-    df_highlights["time_diff_greater"] = df_highlights["time_diff"] < datetime.timedelta(minutes=1)
-    df_highlights["to_remove"] = df_highlights["correlaton_greater"] & df_highlights["time_diff_greater"]
-    logger.info(f"Total initial clippings: {len(df_highlights)}")
-    df_highlights =  df_highlights[~df_highlights["to_remove"]]
-    logger.info(f"Clippings after removing similar notes: {len(df_highlights)}")
-    df_highlights.reset_index(drop=True, inplace=True)
-
-    return df_highlights[["highlight", "meta", "date"]]
-
-def create_df_from_highlights_list(higlights_list: list)-> pd.DataFrame:
-    """Takes a list of highlights and creates a dataframe with the columns ["highlight", "meta", "date"]
+
+def calculate_trigram_similarity(trigrams1: frozenset[str], trigrams2: frozenset[str]) -> float:
+    """Computes the Jaccard similarity between two trigram sets, 1 if any of them is empty so the pair is not discarded."""
+    if not trigrams1 or not trigrams2:
+        return 1.0
+    return len(trigrams1 & trigrams2) / len(trigrams1 | trigrams2)
+
+
+def filter_repeated_highlights(highlights: list[Highlight])-> list[Highlight]:
+    """Takes a list of highlights and removes the repetaed highlights. The most recent highlight is kept.
 
     Parameters
     ----------
-    higlights_list : List
-        List containing the text of the highlights
+    highlights : list[Highlight]
+        List of parsed highlights, in the order they were clipped
     """
-    filtered_highlights = [string for string in higlights_list if string != "..." and string != ""]
-
-    meta_regex_pattern = r"(Your.*\| Added on)"
-
-    highlights_meta = []
-    highlights_date = []
-    highlights_text = []
-    for highlight_line in filtered_highlights:
-        if re.search(meta_regex_pattern, highlight_line):
-            highlights_meta.append(highlight_line)
-            highlight_date = extract_date_and_time(highlight_line)
-            highlights_date.append(highlight_date)
-        else:
-            highlights_text.append(highlight_line)
-    df_highlights = pd.DataFrame({'highlight': highlights_text, 'meta': highlights_meta, 'date': highlights_date})
-    df_highlights = filter_repeated_highlights(df_highlights)
-
-    return df_highlights
+    texts = [highlight.text for highlight in highlights]
+    dates = np.array([highlight.date for highlight in highlights], dtype="datetime64[s]")
+
+    # Each highlight is compared with the next one, the last highlight is always kept
+    to_remove = np.zeros(len(highlights), dtype=bool)
+    if len(highlights) > 1:
+        # Only pairs clipped within a minute can be repeated, the text comparison is skipped for the rest.
+        # Missing dates become NaT, which never compares as within a minute
+        candidates = np.flatnonzero(np.diff(dates) < np.timedelta64(1, "m"))
+        # The trigram similarity is cheap to compute and discards most unrelated pairs before Levenshtein.
+        # The trigrams are built once for each highlight that is part of a candidate pair
+        trigrams = {i: get_trigrams(texts[i]) for i in np.union1d(candidates, candidates + 1)}
+        similarities = np.fromiter(
+            (
+                calculate_similarity(texts[i], texts[i + 1], SIMILARITY_THRESHOLD)
+                if calculate_trigram_similarity(trigrams[i], trigrams[i + 1]) > TRIGRAM_THRESHOLD
+                else 0.0
+                for i in candidates
+            ),
+            dtype=np.float64,
+            count=len(candidates),
+        )
+        to_remove[candidates] = similarities > SIMILARITY_THRESHOLD
+
+    logger.info(f"Total initial clippings: {len(highlights)}")
+    highlights = [highlight for highlight, remove in zip(highlights, to_remove) if not remove]
+    logger.info(f"Clippings after removing similar notes: {len(highlights)}")
+
+    return highlights
 
 def add_page_number(pdf_file: FPDF, page_number:int)->FPDF:
     """Adds a page number to a new page in a FPDF